@@ -6,19 +6,23 @@ from agno.agent import Agent
 from agno.models.openai import OpenAIChat
 
 from textwrap import dedent
+import os
 
+# Set CXR_DEBUG=1 to enable Agno debug logging and tool call output for the QA anchor
+CXR_DEBUG = os.getenv("CXR_DEBUG", "").lower() in ("1", "true", "yes")
 
-def create_reader():
-    cxr_reader: Agent = Agent(
-        name="reader",
-        model=OpenAIChat(id="gpt-4o-mini", temperature=0.4),
-        description=dedent(
-            """
+# Agent prompts are dedented once at import, so every agent built from them sends byte-identical text
+_READER_DESC = dedent(
+    """
     You are an AI-powered CXR Reader specialized in analyzing Chest X-ray images.
 """
-        ),
-        instructions=dedent(
-            """
+)
+
+# The reader's instructions are static and sent unchanged on every request, so they form a
+# stable system prompt prefix that OpenAI's prompt caching can reuse. Per-image patient data
+# must only ever be sent in the user message.
+READER_SYSTEM = dedent(
+    """
     # DO NOT GENERATE SAMPLE, ONLY ANALYZE THE IMAGE
     # DO NOT SAY LIKE "I have analyzed the provided Chest X-ray image. The findings are as follows:  "
     # JUST REPORT! DON'T TALK SHIT!
@@ -33,27 +37,42 @@ def create_reader():
     ### **2. Report Generation:**  
 
     - **Structured Sections:**  
-    Organize the report into the following sections:
+    Organize the report into the following sections, in this exact order:
+    - **Patient Information:** Start the report with a header stating the patient information given in the request:
+    Patient ID / Follow-up / Age / Gender / View Position / Possible Diseases
     - **Findings:** ("Findings" always instaed of "Finding") Describe any abnormalities detected, structured into:
     - Airways  
     - Bones and Soft Tissues  
     - Cardiac Silhouette and Mediastinum  
     - Diaphragm and Pleural Spaces  
     - Lungs  
-    - **Impression:** Summarize the key findings and their possible clinical implications. Provide an overall assessment of the case, integrating the detected abnormalities and their potential significance.
-    - **Plan:** Suggest further diagnostic steps, follow-up recommendations, or potential treatment considerations based on the findings and impression."""
-        ),
-        expected_output="Detailed analysis on CXR, with three big categories: **Findings**, **Impression**, and **Plan**.",
-    )
-    return cxr_reader
+    - **Impression:** Summarize the key findings and their possible clinical implications. Provide an overall assessment of the case, integrating the detected abnormalities and their potential significance. Use bullet points.
+    - **Plan:** Suggest further diagnostic steps, follow-up recommendations, or potential treatment considerations based on the findings and impression. Use bullet points.
 
+    ### **3. Report Format:**  
+    Write the section headers exactly as in this example, and output ONLY THE REPORT:
 
-def create_qa_anchor():
-    qa_anchor: Agent = Agent(
-        name="Q&A_Anchor",
-        model=OpenAIChat(id="gpt-4o-mini", temperature=0.7),
-        description=dedent(
-            """\
+    **Patient Information:**  
+    - Patient ID: 3  
+    - Follow-up: 0  
+    - Age: 81  
+    - Gender: F  
+    - View Position: PA  
+    - Possible Diseases: Hernia 
+
+    **Findings:**
+    ...
+
+    **Impression:**
+    ...
+
+    **Plan:**
+    ..."""
+)
+
+
+_QA_DESC = dedent(
+    """\
     You are the anchor of the human-in-the-loop Q&A section for the CXR report. 
     Must include detailed analysis on :
     - Airways
@@ -66,9 +85,10 @@ def create_qa_anchor():
     Reorganize the Impression and Plan with bullet points.
 
     Your role is to provide clear, accurate answers to any questions the user has regarding the provided CXR report."""
-        ),
-        instructions=dedent(
-            """\
+)
+
+_QA_INSTR = dedent(
+    """\
     0) Add the report header and reconstruct CXR report.
     - **Report Header:**  
     Start the report with a header stating the patient information in the following format:
@@ -99,11 +119,61 @@ def create_qa_anchor():
     4) After each answer, prompt the user with "Do you have further questions?" unless the user responds with "STOP"
     5) When generating the report, ONLY THE REORT, NEVER SAY ADDITIONAL WORDS LIKE "If you have any questions about the report, please ask."                           
     6) If the user says "STOP", return the updated CXR report that incorporates all the additional WEB SEARCHES, insights and modifications discussed during the Q&A. JUST THE REPORT NEVER SAY THANK YOU OR SOMETHING"""
-        ),
+)
+
+
+_COMPACTOR_INSTR = dedent(
+    """\
+    Summarize the Q&A conversation about a CXR report that you are given.
+    - Keep every clinical fact, question, answer and requested change to the report.
+    - If a previous summary is given, merge the new messages into it.
+    - Return ONLY the summary, as short bullet points."""
+)
+
+
+def create_reader():
+    cxr_reader: Agent = Agent(
+        name="reader",
+        model=OpenAIChat(id="gpt-4o-mini", temperature=0.4),
+        description=_READER_DESC,
+        instructions=READER_SYSTEM,
+        expected_output="Detailed CXR report with four sections: **Patient Information**, **Findings**, **Impression**, and **Plan**.",
+    )
+    return cxr_reader
+
+
+def create_qa_anchor(debug: bool = False):
+    qa_anchor: Agent = Agent(
+        name="Q&A_Anchor",
+        model=OpenAIChat(id="gpt-4o-mini", temperature=0.7),
+        description=_QA_DESC,
+        instructions=_QA_INSTR,
         expected_output="Concise, clear, and accurate responses addressing the user's questions about the CXR report, culminating in the final updated CXR report when the session ends.",
         read_chat_history=True,
         add_history_to_messages=True,
-        show_tool_calls=True,
-        debug_mode=True,
+        show_tool_calls=debug,
+        debug_mode=debug,
     )
     return qa_anchor
+
+
+def create_compactor():
+    compactor: Agent = Agent(
+        name="compactor",
+        model=OpenAIChat(id="gpt-4o-mini", temperature=0.2),
+        instructions=_COMPACTOR_INSTR,
+    )
+    return compactor
+
+
+# Output format for reading several images in one request. It is sent with the user message
+# so the reader's system prompt stays the same for single- and multi-image requests.
+BATCH_OUTPUT_INSTRUCTIONS = dedent(
+    """\
+    Several Chest X-ray images are attached, in the order of the indices listed above.
+    Analyze each image separately and return ONLY a JSON array with one object per image:
+    [{"index": 0, "patient_information": "...", "findings": "...", "impression": "...", "plan": "..."}, ...]
+    - "index" is the index of the image in the list above.
+    - "patient_information", "findings", "impression" and "plan" are markdown strings holding the
+      content of each report section (without the section header)."""
+)
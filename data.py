@@ -20,15 +20,56 @@ class CXRRecord:
     view_position: Optional[str] = None
 
 
+# Pusedo define of the two patients and their images
+_PATIENTS = {
+    "00000001": {
+        "images": [
+            {"name": "00000001_000.png", "finding": ["No Finding"], "follow_up": 0},
+            {"name": "00000001_001.png", "finding": ["Pneumonia"], "follow_up": 1},
+            {"name": "00000001_002.png", "finding": ["Effusion"], "follow_up": 2},
+        ],
+        "age": 45,
+        "gender": "M",
+        "view_position": "PA"
+    },
+    "00000002": {
+        "images": [
+            {"name": "00000002_000.png", "finding": ["Nodule"], "follow_up": 0}
+        ],
+        "age": 62,
+        "gender": "F",
+        "view_position": "AP"
+    }
+}
+
+# Image selection labels for each patient, e.g. "[0] 00000001_000.png"
+_IMAGE_OPTIONS = {
+    pid: [f"[{i}] {img['name']}" for i, img in enumerate(p["images"])]
+    for pid, p in _PATIENTS.items()
+}
+
+# Use pathlib for relative path resolution
+SCRIPT_DIR = Path(__file__).parent
+IMAGES_DIR = SCRIPT_DIR / "images"
+
+# Absolute path of each patient's images, resolved once and stored as str for PIL and Agno
+_IMG_PATHS = {
+    pid: [str((IMAGES_DIR / img["name"]).resolve()) for img in p["images"]]
+    for pid, p in _PATIENTS.items()
+}
+
+# Index of each image selection label, so a selection resolves with a dict lookup
+_OPTION_TO_INDEX = {
+    pid: {option: i for i, option in enumerate(options)}
+    for pid, options in _IMAGE_OPTIONS.items()
+}
+
+
 def simplified_path_finder() -> List[tuple]:
     """
     Simplified function that provides only two predefined patients with their images.
     Returns a list of tuples in the same format as the original path_finder.
     """
-    # Use pathlib for relative path resolution
-    SCRIPT_DIR = Path(__file__).parent
-    IMAGES_DIR = SCRIPT_DIR / "images"
-    
     # Create the simplified sidebar
     st.sidebar.header("Patient Selection")
     
@@ -42,28 +83,6 @@ def simplified_path_finder() -> List[tuple]:
     if "data_paths" not in st.session_state:
         st.session_state.data_paths = []
     
-    # Pusedo define of the two patients and their images
-    patients = {
-        "00000001": {
-            "images": [
-                {"name": "00000001_000.png", "finding": ["No Finding"], "follow_up": 0},
-                {"name": "00000001_001.png", "finding": ["Pneumonia"], "follow_up": 1},
-                {"name": "00000001_002.png", "finding": ["Effusion"], "follow_up": 2},
-            ],
-            "age": 45,
-            "gender": "M",
-            "view_position": "PA"
-        },
-        "00000002": {
-            "images": [
-                {"name": "00000002_000.png", "finding": ["Nodule"], "follow_up": 0}
-            ],
-            "age": 62,
-            "gender": "F",
-            "view_position": "AP"
-        }
-    }
-    
     # Let user select one of the two patients
     patient_id = st.sidebar.radio(
         "Select Patient ID", 
@@ -74,15 +93,13 @@ def simplified_path_finder() -> List[tuple]:
     )
     
     # Get the selected patient's data
-    selected_patient = patients[patient_id]
+    selected_patient = _PATIENTS[patient_id]
     
     # Show the patient's images
     st.sidebar.subheader(f"Images for Patient {patient_id}")
     
-    # Create image options for selection
-    image_options = []
-    for i, img in enumerate(selected_patient["images"]):
-        image_options.append(f"[{i}] {img['name']}")
+    # Image options for selection
+    image_options = _IMAGE_OPTIONS[patient_id]
     
     # Let user select images
     selected_indices = st.sidebar.multiselect(
@@ -112,10 +129,9 @@ def simplified_path_finder() -> List[tuple]:
         if not st.session_state.data_paths:
             if all_images:
                 # Process all images for the selected patient
-                for img in selected_patient["images"]:
-                    # Initialize image_path
-                    image_path = IMAGES_DIR / img['name']
-                    
+                for img, image_path in zip(
+                    selected_patient["images"], _IMG_PATHS[patient_id]
+                ):
                     st.session_state.data_paths.append(
                         (
                             image_path,
@@ -130,11 +146,11 @@ def simplified_path_finder() -> List[tuple]:
             elif selected_indices:
                 # Process only selected images
                 for selection in selected_indices:
-                    idx = int(selection.split("]")[0].replace("[", ""))
-                    if 0 <= idx < len(selected_patient["images"]):
+                    idx = _OPTION_TO_INDEX[patient_id].get(selection)
+                    if idx is not None:
                         img = selected_patient["images"][idx]
-                        image_path = IMAGES_DIR / img['name']
-                        
+                        image_path = _IMG_PATHS[patient_id][idx]
+
                         st.session_state.data_paths.append(
                             (
                                 image_path,
@@ -159,13 +175,8 @@ def simplified_path_finder() -> List[tuple]:
                 filename = path.name if isinstance(path, Path) else Path(path).name  # Handle both Path and string
                 st.sidebar.write(f"{i+1}. {filename}")
     
-    # Convert Path objects to strings before returning
-    string_paths = [
-        (str(path) if isinstance(path, Path) else path, *rest)
-        for path, *rest in st.session_state.data_paths
-    ]
-    
-    return string_paths
+    # Image paths are already stored as strings
+    return list(st.session_state.data_paths)
 
 
 # Replace the original path_finder with our simplified version
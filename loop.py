@@ -7,59 +7,379 @@ current_image_index: 현재 처리 중인 이미지의 인덱스
 reports_generated: "Generate Reports" 버튼이 클릭되었는지 여부
 all_reports_complete: 모든 보고서 생성이 완료되었는지 여부
 all_reports: 생성된 모든 보고서를 저장하는 리스트
+all_reports_by_key: (patient_id, follow_up)별 all_reports 인덱스
 processing_complete: 현재 이미지에 대한 처리가 완료되었는지 여부
 records: 처리 중인 환자 기록 데이터
+_report_seq: 다음에 저장될 보고서의 ID (세션 내 순번)
+batch_id: Batch mode에서 제출된 OpenAI Batch API 작업의 ID
+generator: 세션별로 한 번만 생성되는 CXR_Report_Generator
+reader_cache: 이미지 내용과 환자 정보의 해시별 reader 보고서 (초기화 후에도 유지)
 
 이미지별 동적 키 (image_id 기반):
 qa_complete_{image_id}: 특정 이미지의 Q&A 세션이 완료되었는지 여부
 final_report_{image_id}: 특정 이미지의 최종 보고서
 chat_history_{image_id}: 특정 이미지의 Q&A 세션 채팅 기록
+chat_context_{image_id}: 채팅 기록을 이어 붙인 QA 앵커용 문자열과 그 토큰 수
+chat_summary_{image_id}: 토큰 예산을 넘은 오래된 채팅 기록의 (요약된 메시지 수, 요약)
 report_{image_id}: 특정 이미지의 초기 보고서
 qa_anchor_{image_id}: 특정 이미지의 QA 앵커
 current_report_{image_id}: Q&A 세션 중 업데이트되는 보고서 내용
 """
 
+from agno.agent import RunResponse
 from agno.media import Image
+from concurrent.futures import ThreadPoolExecutor
+from openai import OpenAI
+from PIL import Image as PILImage
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 from textwrap import dedent
+import asyncio
+import base64
+import io
+import json
+import os
 import streamlit as st
-import uuid
 from datetime import datetime
-from reader import CXR_Report_Generator, parse_report
+from reader import (
+    CXR_Report_Generator,
+    parse_report,
+    is_usable_report,
+    MAX_IMAGES_PER_REQUEST,
+)
 from data import path_finder
 from pdf_export import generate_pdf
 
 
+# Longest side of the preview thumbnails in the Selected Images grid
+THUMBNAIL_SIZE = 512
+
+
+@st.cache_data(show_spinner=False)
+def _thumb(path: str, mtime: float) -> bytes:
+    """
+    Downscale an image to a PNG preview thumbnail.
+
+    Args:
+        path: Path to the image file
+        mtime: Modification time of the file, so the cache is refreshed when it changes
+
+    Returns:
+        bytes: The thumbnail encoded as PNG
+    """
+    with PILImage.open(path) as image:
+        image.thumbnail((THUMBNAIL_SIZE, THUMBNAIL_SIZE), PILImage.LANCZOS)
+        buffer = io.BytesIO()
+        image.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+# Worker threads used to render report PDFs in parallel
+PDF_WORKERS = 4
+
+
+@st.cache_data(show_spinner=False, max_entries=64)
+def _report_pdf(report_data, patient_record):
+    """Generate a report's PDF, memoized by the report's ID and content and its patient record."""
+    return generate_pdf(report_data, patient_record=patient_record)
+
+
+def generate_report_pdfs(reports, records):
+    """
+    Generate the PDFs for several reports in parallel.
+
+    Args:
+        reports: Saved report dictionaries
+        records: Patient records, used to find the record matching each report's patient ID
+
+    Returns:
+        list: The PDF bytes (or None on failure) for each report, in order
+    """
+    # Match each report to the first record with the same patient ID
+    records_by_patient = {}
+    for record in records:
+        records_by_patient.setdefault(str(record[3]), record)
+    patient_records = [
+        records_by_patient.get(str(report_data.get("patient_id")))
+        for report_data in reports
+    ]
+
+    # Worker threads share this script run's context so st.cache_data and st.error work in them
+    ctx = get_script_run_ctx()
+    with ThreadPoolExecutor(
+        max_workers=PDF_WORKERS, initializer=add_script_run_ctx, initargs=(None, ctx)
+    ) as executor:
+        return list(executor.map(_report_pdf, reports, patient_records))
+
+
+def get_generator():
+    """Return this session's report generator, building its agents only on first use."""
+    if "generator" not in st.session_state:
+        st.session_state.generator = CXR_Report_Generator()
+    return st.session_state.generator
+
+
+def image_id_for(index, record):
+    """Build the unique image_id used to key per-image session state."""
+    return f"img_{index}_{record[3]}"
+
+
+def build_query(record):
+    """Build the patient information query for a record."""
+    return dedent(
+        f"""
+    possible disease: {record[1]}
+    follow-up: {record[2]}
+    patient id: {record[3]}
+    patient age: {record[4]}
+    patient gender: {record[5]}
+    view position: {record[6]}
+    """
+    )
+
+
+def prefetch_reports(generator, records):
+    """Generate the reader reports for every record ahead of the Q&A sessions."""
+    pending = {}
+    for i, record in enumerate(records):
+        image_id = image_id_for(i, record)
+        if f"report_{image_id}" not in st.session_state:
+            pending[image_id] = (Image(filepath=record[0]), build_query(record))
+
+    if not pending:
+        return
+
+    with st.spinner(f"Generating CXR reports for {len(pending)} image(s)..."):
+        reports = {}
+
+        # Read all images in one request when they fit, so the prompt is sent only once
+        if 1 < len(pending) <= MAX_IMAGES_PER_REQUEST:
+            image_ids = list(pending)
+            batched = generator.generate_cxr_reports_batched(
+                [pending[image_id][0] for image_id in image_ids],
+                [pending[image_id][1] for image_id in image_ids],
+            )
+            for image_id, reader_ans in zip(image_ids, batched):
+                if reader_ans is not None:
+                    reports[image_id] = reader_ans
+                    del pending[image_id]
+
+        # Fall back to one concurrent request per image for whatever is left,
+        # streaming each report into its own placeholder as it is generated
+        if pending:
+            stream_area = st.empty()
+            placeholders = {}
+            with stream_area.container():
+                for image_id in pending:
+                    st.caption(f"Report for {image_id}")
+                    placeholders[image_id] = st.empty()
+
+            reports.update(
+                asyncio.run(
+                    generator.agenerate_cxr_reports(pending, placeholders=placeholders)
+                )
+            )
+
+            # The finished reports are shown in each image's Q&A section
+            stream_area.empty()
+
+    for image_id, reader_ans in reports.items():
+        st.session_state[f"report_{image_id}"] = reader_ans
+
+
+@st.fragment
+def qa_block(generator, image_id, current_record):
+    """
+    Run the report generation and Q&A session for one image.
+
+    This is a fragment, so submitting a Q&A message reruns only this block
+    instead of the whole page (records, image grid, generator lookup).
+    Finishing the session ("stop") still reruns the whole page, so the edit
+    step below the fragment is shown.
+    """
+    # Load image and prepare query
+    image = Image(filepath=current_record[0])
+    query = build_query(current_record)
+
+    with st.spinner(f"Generating report for patient ID {current_record[3]}..."):
+        generator.run(query=query, image=image, image_id=image_id)
+        st.session_state.processing_complete = False
+
+    # The Workflow records every run() (inputs and response) in its memory. Nothing reads it
+    # back and the generator lives for the whole session, so drop the runs to keep it bounded.
+    if generator.memory is not None:
+        generator.memory.runs.clear()
+
+
+def clear_image_state():
+    """Remove all per-image session state (reports, Q&A sessions, and final reports)."""
+    prefixes = (
+        "qa_complete_",
+        "final_report_",
+        "chat_history_",
+        "chat_context_",
+        "chat_summary_",
+        "report_",
+        "qa_anchor_",
+        "current_report_",
+    )
+    for key in list(st.session_state.keys()):
+        if key.startswith(prefixes):
+            del st.session_state[key]
+    # A pending batch was submitted for the old records
+    st.session_state.pop("batch_id", None)
+
+
+def submit_batch(records):
+    """
+    Submit the reader request for every record as a single OpenAI Batch API job.
+
+    Args:
+        records: Patient records to generate reports for
+
+    Returns:
+        str: The ID of the created batch, or None if it could not be submitted
+    """
+    client = OpenAI()
+    reader = get_generator().reader
+    # Use the exact system prompt the reader agent sends, so the batch output matches it
+    system_prompt = reader.get_system_message().content
+
+    lines = []
+    for i, record in enumerate(records):
+        with open(record[0], "rb") as image_file:
+            encoded_image = base64.b64encode(image_file.read()).decode("ascii")
+
+        body = {
+            "model": reader.model.id,
+            "temperature": reader.model.temperature,
+            "messages": [
+                {"role": "system", "content": system_prompt},
+                {
+                    "role": "user",
+                    "content": [
+                        {"type": "text", "text": build_query(record)},
+                        {
+                            "type": "image_url",
+                            "image_url": {"url": f"data:image/png;base64,{encoded_image}"},
+                        }
+                    ],
+                },
+            ],
+        }
+        lines.append(
+            json.dumps(
+                {
+                    "custom_id": image_id_for(i, record),
+                    "method": "POST",
+                    "url": "/v1/chat/completions",
+                    "body": body,
+                }
+            )
+        )
+
+    try:
+        batch_file = client.files.create(
+            file=("reader_batch.jsonl", "\n".join(lines).encode("utf-8")),
+            purpose="batch",
+        )
+        batch = client.batches.create(
+            input_file_id=batch_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h",
+        )
+    except Exception as e:
+        st.error(f"Error submitting batch: {str(e)}")
+        return None
+    return batch.id
+
+
+# Batch statuses after which the batch will not change anymore
+BATCH_TERMINAL_STATUSES = ("completed", "failed", "expired", "cancelled")
+
+
+def check_batch(batch_id):
+    """
+    Look up a batch's status once; the page polls again on the next rerun.
+
+    Returns:
+        The batch, or None if its status could not be retrieved
+    """
+    try:
+        return OpenAI().batches.retrieve(batch_id)
+    except Exception as e:
+        st.error(f"Error checking batch {batch_id}: {str(e)}")
+        return None
+
+
+def collect_batch_reports(batch):
+    """Download a finished batch's output and store each usable report in session state."""
+    if batch.status != "completed":
+        st.warning(
+            f"Batch {batch.id} {batch.status}. The reports will be generated without the Batch API."
+        )
+    if batch.output_file_id is None:
+        return
+
+    try:
+        output = OpenAI().files.content(batch.output_file_id).text
+    except Exception as e:
+        st.error(f"Error downloading batch results: {str(e)}")
+        return
+
+    failed = 0
+    for line in output.splitlines():
+        if not line.strip():
+            continue
+        result = json.loads(line)
+        response = result.get("response") or {}
+        if response.get("status_code") != 200:
+            failed += 1
+            continue
+
+        content = response["body"]["choices"][0]["message"]["content"] or ""
+        # Reports that fail the checks are regenerated interactively instead
+        if is_usable_report(content):
+            st.session_state[f"report_{result['custom_id']}"] = RunResponse(content=content)
+
+    if failed:
+        st.warning(
+            f"{failed} batch request(s) failed. Their reports will be generated without the Batch API."
+        )
+
+
 def save_report(report_content, patient_id="Unknown", follow_up=""):
     """Save the report to reports collection. Deduplicate if the same patient ID and follow-up exists."""
+    # Report IDs only need to be unique within the session
+    report_id = st.session_state.get("_report_seq", 0)
+    st.session_state["_report_seq"] = report_id + 1
+
     new_report = {
-        "id": str(uuid.uuid4()),
+        "id": report_id,
         "content": report_content,
-        "created_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "created_at": datetime.now().isoformat(sep=" ", timespec="seconds"),
         "patient_id": patient_id,
         "follow_up": follow_up,
     }
 
-    # Check if we already have a report with the same patient ID and follow-up
-    if "all_reports" in st.session_state:
-        existing_indices = []
-        for i, report in enumerate(st.session_state["all_reports"]):
-            if (
-                report.get("patient_id") == patient_id
-                and report.get("follow_up") == follow_up
-                and patient_id != "Unknown"
-            ):  # Only deduplicate if patient ID is known
-                existing_indices.append(i)
-
-        # Remove any duplicate reports (from newest to oldest to maintain index validity)
-        for idx in sorted(existing_indices, reverse=True):
-            st.session_state["all_reports"].pop(idx)
-
-    # Initialize all_reports if it doesn't exist
+    # Initialize all_reports and its (patient_id, follow_up) index if they don't exist
     if "all_reports" not in st.session_state:
         st.session_state["all_reports"] = []
-
-    # Add the new report
-    st.session_state["all_reports"].append(new_report)
+    if "all_reports_by_key" not in st.session_state:
+        st.session_state["all_reports_by_key"] = {}
+
+    # Only deduplicate if patient ID is known
+    if patient_id == "Unknown":
+        st.session_state["all_reports"].append(new_report)
+        return new_report
+
+    # Replace the existing report with the same patient ID and follow-up in place
+    key = (patient_id, follow_up)
+    idx = st.session_state["all_reports_by_key"].get(key)
+    if idx is not None:
+        st.session_state["all_reports"][idx] = new_report
+    else:
+        st.session_state["all_reports_by_key"][key] = len(st.session_state["all_reports"])
+        st.session_state["all_reports"].append(new_report)
     return new_report
 
 
@@ -91,6 +411,7 @@ def main():
         st.session_state.reports_generated = False
         st.session_state.all_reports_complete = False
         st.session_state.all_reports = []
+        st.session_state.all_reports_by_key = {}
         st.session_state.processing_complete = False
 
     # Check if we've moved to a new image index but haven't reset processing_complete
@@ -105,17 +426,12 @@ def main():
     cols = st.columns([3, 1])
     with cols[1]:
         if st.button("Reset Processing"):
-            for key in list(st.session_state.keys()):
-                if (
-                    key.startswith("qa_complete_")
-                    or key.startswith("final_report_")
-                    or key.startswith("chat_history_")
-                ):
-                    del st.session_state[key]
+            clear_image_state()
             st.session_state.current_image_index = 0
             st.session_state.reports_generated = False
             st.session_state.all_reports_complete = False
             st.session_state.all_reports = []
+            st.session_state.all_reports_by_key = {}
             st.session_state.processing_complete = False
             st.success("Processing reset. You can start again.")
             st.rerun()
@@ -130,16 +446,18 @@ def main():
 
     st.success(f"Loaded {len(records)} patient record(s)")
 
-    # Check if the number of records has changed since last run
-    if "records" in st.session_state and len(st.session_state.records) != len(records):
-        # Reset processing state for a new set of records
+    # Check if the records have changed since last run
+    if "records" in st.session_state and st.session_state.records != records:
+        # Reset processing state for a new set of records.
+        # Per-image keys are positional, so reports for the old records must not be reused.
+        clear_image_state()
         st.session_state.current_image_index = 0
         st.session_state.reports_generated = False
         st.session_state.all_reports_complete = False
         st.session_state.processing_complete = False
 
-    # Initialize the report generator
-    generator = CXR_Report_Generator()
+    # Get the report generator (built once per session)
+    generator = get_generator()
 
     # Display selected images
     st.subheader("Selected Images")
@@ -148,12 +466,20 @@ def main():
     for i, record in enumerate(records):
         with image_cols[i % min(3, len(records))]:
             st.image(
-                record[0], caption=f"Follow-up: {record[2]}", use_container_width=True
+                _thumb(record[0], os.path.getmtime(record[0])),
+                caption=f"Follow-up: {record[2]}",
+                use_container_width=True,
             )
 
     # Store records in session state for access during processing
     st.session_state.records = records
 
+    # Batch API jobs are half the price but can take up to 24 hours to complete
+    batch_mode = st.checkbox(
+        "Batch mode (OpenAI Batch API: lower cost, results may take hours)",
+        key="batch_mode",
+    )
+
     # Generate reports button
     if st.button("Generate Reports") or st.session_state.reports_generated:
         # If we're just starting with Generate Reports, ensure all processing flags are reset
@@ -164,6 +490,34 @@ def main():
 
         st.session_state.reports_generated = True
 
+        if batch_mode and any(
+            f"report_{image_id_for(i, record)}" not in st.session_state
+            for i, record in enumerate(st.session_state.records)
+        ):
+            if "batch_id" not in st.session_state:
+                batch_id = submit_batch(st.session_state.records)
+                if batch_id is None:
+                    st.stop()
+                st.session_state.batch_id = batch_id
+
+            # Poll once per rerun instead of blocking the script until the batch finishes
+            batch = check_batch(st.session_state.batch_id)
+            if batch is None or batch.status not in BATCH_TERMINAL_STATUSES:
+                if batch is not None:
+                    counts = batch.request_counts
+                    done = f" ({counts.completed}/{counts.total} done)" if counts else ""
+                    st.info(
+                        f"Batch {batch.id} is {batch.status}{done}. Results may take up to 24 hours."
+                    )
+                st.button("Check again")
+                st.stop()
+
+            collect_batch_reports(batch)
+            del st.session_state.batch_id
+
+        # Run every reader request up front so the per-image Q&A sessions don't wait on them
+        prefetch_reports(generator, st.session_state.records)
+
         # Process each image/record sequentially
         if st.session_state.current_image_index < len(st.session_state.records):
             current_record = st.session_state.records[
@@ -171,25 +525,12 @@ def main():
             ]
 
             # Create a unique image_id
-            image_id = f"img_{st.session_state.current_image_index}_{current_record[3]}"
+            image_id = image_id_for(st.session_state.current_image_index, current_record)
 
             st.subheader(
                 f"Processing image {st.session_state.current_image_index + 1}/{len(st.session_state.records)}"
             )
 
-            # Load image and prepare query
-            image = Image(filepath=current_record[0])
-            query = dedent(
-                f"""
-            possible disease: {current_record[1]}
-            follow-up: {current_record[2]}
-            patient id: {current_record[3]}
-            patient age: {current_record[4]}
-            patient gender: {current_record[5]}
-            view position: {current_record[6]}
-            """
-            )
-
             # Check if this Q&A session is complete
             qa_complete_key = f"qa_complete_{image_id}"
 
@@ -224,7 +565,7 @@ def main():
 
                     # Combine all edited sections back into a single report
                     final_report_content = "\n\n".join(
-                        [f"{key}\n{value}" for key, value in parsed_report.items()]
+                        f"{key}\n{value}" for key, value in parsed_report.items()
                     )
 
                     # Save the report with deduplication if same patient_id and follow_up
@@ -237,7 +578,9 @@ def main():
                         "content": final_report_content,
                         "patient_id": patient_id,
                         "follow_up": follow_up,
-                        "created_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                        "created_at": datetime.now().isoformat(
+                            sep=" ", timespec="seconds"
+                        ),
                     }
                     pdf_bytes = generate_pdf(
                         edited_report, patient_record=current_record
@@ -283,17 +626,15 @@ def main():
                         next_record = st.session_state.records[
                             st.session_state.current_image_index
                         ]
-                        next_image_id = f"img_{st.session_state.current_image_index}_{next_record[3]}"
+                        next_image_id = image_id_for(
+                            st.session_state.current_image_index, next_record
+                        )
                         qa_complete_next_key = f"qa_complete_{next_image_id}"
                         if qa_complete_next_key in st.session_state:
                             del st.session_state[qa_complete_next_key]
 
-                        # Also clear report keys for the next image to ensure fresh processing
-                        report_key_next = f"report_{next_image_id}"
-                        if report_key_next in st.session_state:
-                            del st.session_state[report_key_next]
-
-                        # Clear other related keys for the next image
+                        # Clear other related keys for the next image.
+                        # The prefetched reader report (report_{image_id}) is kept.
                         keys_to_clear = [
                             f"qa_anchor_{next_image_id}",
                             f"current_report_{next_image_id}",
@@ -317,16 +658,17 @@ def main():
                     st.session_state.get("all_reports", [])
                 ):
                     # Generate the report and start Q&A session
-                    with st.spinner(
-                        f"Generating report for patient ID {current_record[3]}..."
-                    ):
-                        generator.run(query=query, image=image, image_id=image_id)
-                        st.session_state.processing_complete = False
+                    qa_block(generator, image_id, current_record)
 
         # After all reports are processed, show the editing interface
         elif st.session_state.all_reports_complete:
             st.subheader("All Reports Generated")
 
+            # Render every report's PDF up front, in parallel
+            all_pdf_bytes = generate_report_pdfs(
+                st.session_state["all_reports"], st.session_state.get("records", [])
+            )
+
             # Display and allow viewing of all reports
             for i, report_data in enumerate(st.session_state["all_reports"]):
                 with st.expander(
@@ -342,16 +684,8 @@ def main():
                                 st.markdown(f"### {key}")
                                 st.markdown(value)
 
-                    # Generate PDF and display download link
-                    # Find the corresponding patient record if available
-                    patient_record = None
-                    if "records" in st.session_state:
-                        for record in st.session_state.records:
-                            if str(record[3]) == str(report_data.get("patient_id")):
-                                patient_record = record
-                                break
-
-                    pdf_bytes = generate_pdf(report_data, patient_record=patient_record)
+                    # Display download link
+                    pdf_bytes = all_pdf_bytes[i]
                     if pdf_bytes is not None:
                         st.download_button(
                             label=f"Download Report {i+1}",
@@ -2,15 +2,39 @@
 마크다운 형식의 보고서를 PDF로 변환하는 script입니다.
 """
 
-import streamlit as st
 from datetime import datetime
-
-try:
-    from fpdf import FPDF
-
-    PDF_AVAILABLE = True
-except ImportError:
-    PDF_AVAILABLE = False
+import functools
+import importlib.util
+import io
+import re
+import threading
+
+# fpdf is only imported when a PDF is actually generated
+PDF_AVAILABLE = importlib.util.find_spec("fpdf") is not None
+
+# Row labels of the patient record table, in patient record order (without the image path)
+LABELS = (
+    "Finding Labels",
+    "Follow-up",
+    "Patient ID",
+    "Age",
+    "Gender",
+    "View Position",
+)
+
+# String widths keyed by (font_family, font_style, font_size_pt, text)
+_WIDTH_CACHE = {}
+_WIDTH_CACHE_MAX = 4096
+_WIDTH_CACHE_LOCK = threading.Lock()
+
+# Markdown line patterns, compiled once at import
+_HDR_RE = re.compile(r"^(#{1,3}) (.*)$")
+_BULLET_RE = re.compile(r"^(\s*)[-*] \s*(\S.*)$")
+# Splitting on a capturing group keeps each **bold** run as its own piece
+_BOLD_RE = re.compile(r"(\*\*.+?\*\*)")
+
+# (size, style) of "#", "##" and "###" headers
+_HEADER_FONTS = ((16, "B"), (14, "B"), (13, "B"))
 
 
 def generate_pdf(report_data, patient_record=None):
@@ -24,6 +48,8 @@ def generate_pdf(report_data, patient_record=None):
     Returns:
         bytes: PDF file as bytes
     """
+    import streamlit as st
+
     if not PDF_AVAILABLE:
         st.error(
             "PDF generation requires the fpdf package. Please install it with 'pip install fpdf'."
@@ -32,7 +58,13 @@ def generate_pdf(report_data, patient_record=None):
 
     try:
         # Create PDF instance
+        # fpdf is kept as the backend: the reports are one or two pages, so a streaming
+        # (e.g. Rust-backed) writer would not reduce peak memory meaningfully
+        from fpdf import FPDF
+
         pdf = FPDF()
+        # The document is only ever output with dest="S", so it can be built straight into bytes
+        pdf.buffer = _ByteBuffer()
         pdf.add_page()
 
         # Set up font
@@ -42,11 +74,9 @@ def generate_pdf(report_data, patient_record=None):
         pdf.set_font("Arial", "B", 16)
         patient_id = report_data.get("patient_id", "Unknown")
         follow_up = report_data.get("follow_up", "N/A")
-        pdf.cell(
-            200,
-            10,
-            txt=f"CXR Report - Patient ID: {patient_id}, Follow-up: {follow_up}",
-            ln=True,
+        _text_line(
+            pdf,
+            f"CXR Report - Patient ID: {patient_id}, Follow-up: {follow_up}",
             align="C",
         )
         pdf.ln(5)
@@ -56,57 +86,39 @@ def generate_pdf(report_data, patient_record=None):
         created_at = report_data.get(
             "created_at", datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         )
-        pdf.cell(200, 10, txt=f"Created: {created_at}", ln=True)
+        _text_line(pdf, f"Created: {created_at}")
 
         # Add patient record data if available
         if patient_record:
             pdf.ln(5)
             pdf.set_font("Arial", "B", 12)
-            pdf.cell(200, 10, txt="Patient Record", ln=True)
+            _text_line(pdf, "Patient Record")
             pdf.set_font("Arial", size=10)
 
-            # Unpack patient record information
-            (
-                image_path,
-                finding_labels,
-                follow_up,
-                patient_id,
-                patient_age,
-                patient_gender,
-                view_position,
-            ) = patient_record
-
             # Format finding labels for better readability
+            finding_labels = patient_record[1]
             formatted_findings = (
                 ", ".join(finding_labels)
                 if isinstance(finding_labels, list)
                 else str(finding_labels)
             )
 
-            # Create a table-like structure with patient data
-            patient_data = [
-                ("Finding Labels", formatted_findings),
-                ("Follow-up", str(follow_up) if follow_up is not None else "N/A"),
-                ("Patient ID", str(patient_id) if patient_id is not None else "N/A"),
-                ("Age", str(patient_age) if patient_age is not None else "N/A"),
-                (
-                    "Gender",
-                    str(patient_gender) if patient_gender is not None else "N/A",
-                ),
-                (
-                    "View Position",
-                    str(view_position) if view_position is not None else "N/A",
-                ),
+            # Create a table-like structure with patient data; the record's fields after the
+            # finding labels (follow-up, patient ID, age, gender, view position) follow LABELS
+            values = (formatted_findings, *patient_record[2:])
+            patient_data = list(zip(LABELS, map(_n, values)))
+            # Ensure each value fits within the remaining width by truncating if necessary
+            rows = [
+                (label, value if len(value) <= 60 else value[:50] + "...")
+                for label, value in patient_data
             ]
 
             # Draw patient data in table format
             col_width = 40
+            max_value_width = 150
             row_height = 6
-            for label, value in patient_data:
+            for label, value_text in rows:
                 pdf.cell(col_width, row_height, txt=label, border=1)
-                # Ensure value fits within the remaining width by truncating if necessary
-                max_value_width = 150
-                value_text = value[:50] + "..." if len(value) > 60 else value
                 pdf.cell(max_value_width, row_height, txt=value_text, border=1, ln=True)
 
         pdf.ln(10)
@@ -116,7 +128,7 @@ def generate_pdf(report_data, patient_record=None):
             if key not in ("id", "created_at", "patient_id", "follow_up", "content"):
                 # Section header
                 pdf.set_font("Arial", "B", 14)
-                pdf.cell(200, 10, txt=key, ln=True)
+                _text_line(pdf, key)
                 pdf.ln(2)
 
                 # Section content
@@ -128,7 +140,7 @@ def generate_pdf(report_data, patient_record=None):
                 process_markdown_to_pdf(pdf, value)
 
         # Get the PDF as bytes
-        pdf_output = pdf.output(dest="S").encode("latin1")
+        pdf_output = pdf.output(dest="S").getvalue()
         return pdf_output
 
     except Exception as e:
@@ -136,6 +148,57 @@ def generate_pdf(report_data, patient_record=None):
         return None
 
 
+def _n(value):
+    """Format a patient record value for the PDF, using "N/A" for missing values."""
+    return "N/A" if value is None else str(value)
+
+
+def _text_line(pdf, txt, w=200, h=10, align=""):
+    """
+    Draw a borderless, unfilled line of text and move below it.
+
+    Lays the text out like pdf.cell(w, h, txt=txt, ln=True, align=align) at the left margin,
+    but emits it with the lighter pdf.text primitive.
+    """
+    if pdf.get_y() + h > pdf.page_break_trigger and pdf.accept_page_break():
+        pdf.add_page()
+
+    if align == "C":
+        x = pdf.l_margin + (w - pdf.get_string_width(txt)) / 2
+    else:
+        x = pdf.l_margin + pdf.c_margin
+    # Same baseline as a cell: vertically centered, offset by the font's ascent
+    y = pdf.get_y() + 0.5 * h + 0.3 * pdf.font_size
+    pdf.text(x, y, txt)
+    # cell() records the line height, which a bare ln() later advances by
+    pdf.lasth = h
+    pdf.set_y(pdf.get_y() + h)
+
+
+class _ByteBuffer:
+    """
+    Drop-in replacement for FPDF's document buffer that writes straight to bytes.
+
+    FPDF 1.7 only appends to its buffer with += and takes len() of it for the xref offsets, and
+    output(dest="S") returns the buffer itself, so the document is never held as a str as well.
+    Only use it for documents output with dest="S"; the other destinations encode or print the
+    buffer as a str.
+    """
+
+    def __init__(self):
+        self._stream = io.BytesIO()
+
+    def __iadd__(self, s):
+        self._stream.write(s.encode("latin1"))
+        return self
+
+    def __len__(self):
+        return self._stream.tell()
+
+    def getvalue(self):
+        return self._stream.getvalue()
+
+
 def process_markdown_to_pdf(pdf, markdown_text):
     """
     Process markdown text into PDF format with basic formatting
@@ -144,88 +207,127 @@ def process_markdown_to_pdf(pdf, markdown_text):
         pdf: FPDF instance
         markdown_text: Text with markdown formatting
     """
-    # Split text into lines for processing
-    lines = markdown_text.split("\n")
+    # Bind the FPDF methods once; each line issues several calls
+    set_font = pdf.set_font
+    cell = pdf.cell
+    multi_cell = pdf.multi_cell
+    ln = pdf.ln
 
-    current_indent = 0
-    in_list = False
+    for op in _parse_markdown(markdown_text):
+        kind = op[0]
 
-    for line in lines:
-        if not line.strip():
+        if kind == "blank":
             # Add space for empty lines
-            pdf.ln(5)
-            continue
-
-        # Check for headers
-        if line.startswith("# "):
-            pdf.set_font("Arial", "B", 16)
-            pdf.cell(0, 10, txt=line[2:].strip(), ln=True)
-            pdf.ln(2)
-            continue
-        elif line.startswith("## "):
-            pdf.set_font("Arial", "B", 14)
-            pdf.cell(0, 10, txt=line[3:].strip(), ln=True)
-            pdf.ln(2)
-            continue
-        elif line.startswith("### "):
-            pdf.set_font("Arial", "B", 13)
-            pdf.cell(0, 10, txt=line[4:].strip(), ln=True)
-            pdf.ln(2)
-            continue
-
-        # Check for bullet points
-        if line.strip().startswith("- ") or line.strip().startswith("* "):
-            in_list = True
-            indent = len(line) - len(line.lstrip())
-            if indent > current_indent:
-                current_indent = indent
-
-            bullet_text = line.strip()[2:].strip()
-
-            # Determine indentation level (for nested lists)
-            indent_level = indent // 2
+            ln(5)
+        elif kind == "header":
+            _, (size, style), text = op
+            set_font("Arial", style, size)
+            cell(0, 10, txt=text, ln=True)
+            ln(2)
+        elif kind == "bullet":
+            _, indent_level, bullet_text = op
             pdf.set_x(10 + (indent_level * 5))
 
             # Draw bullet
-            pdf.set_font("Arial", size=10)
-            pdf.cell(
+            set_font("Arial", size=10)
+            cell(
                 5, 5, txt="-", ln=0
             )  # Use hyphen instead of bullet point to avoid encoding issues
 
             # Draw bullet text
-            pdf.set_font("Arial", size=12)
-            pdf.multi_cell(0, 5, txt=bullet_text)
-            continue
-        elif (
-            in_list
-            and line.strip()
-            and not (line.strip().startswith("- ") or line.strip().startswith("* "))
-        ):
-            in_list = False
-            current_indent = 0
-
-        # Process bold text with **text** format
-        if "**" in line:
-            parts = line.split("**")
+            set_font("Arial", size=12)
+            multi_cell(0, 5, txt=bullet_text)
+        elif kind == "rich":
+            # Process bold text with **text** format
             x_pos = pdf.get_x()
+            max_x = pdf.w - 20
 
-            for i, part in enumerate(parts):
+            for bold, part in op[1]:
                 # Toggle between normal and bold
-                if i % 2 == 1:  # Odd indices are bold
-                    pdf.set_font("Arial", "B", 12)
+                if bold:
+                    set_font("Arial", "B", 12)
                 else:
-                    pdf.set_font("Arial", size=12)
+                    set_font("Arial", size=12)
 
-                if part:
-                    width = pdf.get_string_width(part)
-                    if x_pos + width > pdf.w - 20:  # Check if we need to wrap
-                        pdf.ln()
-                        x_pos = pdf.get_x()
-                    pdf.cell(width, 5, txt=part, ln=0)
-                    x_pos += width
+                width = _string_width(pdf, part)
+                if x_pos + width > max_x:  # Check if we need to wrap
+                    ln()
+                    x_pos = pdf.get_x()
+                cell(width, 5, txt=part, ln=0)
+                x_pos += width
 
-            pdf.ln()
+            ln()
         else:
             # Normal text
-            pdf.set_font("Arial", size=12)
-            pdf.multi_cell(0, 5, txt=line)
+            set_font("Arial", size=12)
+            multi_cell(0, 5, txt=op[1])
+
+
+def _string_width(pdf, text):
+    """
+    Return pdf.get_string_width(text) for the current font, memoized by font and text.
+
+    Font metrics are fixed per font, so recurring bold labels and values are measured once.
+    """
+    key = (pdf.font_family, pdf.font_style, pdf.font_size_pt, text)
+    width = _WIDTH_CACHE.get(key)
+    if width is None:
+        width = pdf.get_string_width(text)
+        with _WIDTH_CACHE_LOCK:
+            if len(_WIDTH_CACHE) >= _WIDTH_CACHE_MAX:
+                # Evict the oldest entry
+                _WIDTH_CACHE.pop(next(iter(_WIDTH_CACHE)))
+            _WIDTH_CACHE[key] = width
+    return width
+
+
+# Re-exporting a report (often after a small edit) parses mostly identical sections again
+@functools.lru_cache(maxsize=32)
+def _parse_markdown(markdown_text):
+    """
+    Parse markdown text into a tuple of layout operations for process_markdown_to_pdf.
+
+    Args:
+        markdown_text: Text with markdown formatting
+
+    Returns:
+        tuple: One operation per line, such as ("header", (size, style), text)
+    """
+    ops = []
+
+    # Split text into lines for processing
+    for line in markdown_text.split("\n"):
+        stripped = line.strip()
+        if not stripped:
+            ops.append(("blank",))
+            continue
+
+        # Check for headers
+        m = _HDR_RE.match(line)
+        if m:
+            font = _HEADER_FONTS[len(m.group(1)) - 1]
+            ops.append(("header", font, m.group(2).strip()))
+            continue
+
+        # Check for bullet points
+        m = _BULLET_RE.match(line)
+        if m:
+            # Determine indentation level (for nested lists)
+            indent = len(m.group(1))
+            ops.append(("bullet", indent // 2, m.group(2).strip()))
+            continue
+
+        if "**" in line:
+            parts = []
+            for piece in _BOLD_RE.split(line):
+                if len(piece) > 4 and piece.startswith("**") and piece.endswith("**"):
+                    parts.append((True, piece[2:-2]))
+                elif piece:
+                    # Unpaired ** markers are printed as they are
+                    parts.append((False, piece))
+            parts = tuple(parts)
+            ops.append(("rich", parts))
+        else:
+            ops.append(("text", line))
+
+    return tuple(ops)
@@ -7,10 +7,211 @@ from agno.agent import Agent, RunResponse
 from agno.workflow import Workflow
 from agno.media import Image
 from agno.utils.log import logger
+from openai import AsyncOpenAI
+from typing import Any, Dict, List, Optional, Tuple
+import asyncio
+import functools
+import hashlib
+import httpx
+import json
 import re
 from textwrap import dedent
-from agent import create_reader, create_qa_anchor
-import streamlit as st
+
+try:
+    import tiktoken
+
+    TIKTOKEN_AVAILABLE = True
+except ImportError:
+    TIKTOKEN_AVAILABLE = False
+
+# Upper bound on reader requests in flight at once when generating reports concurrently
+MAX_CONCURRENT_READS = 5
+# Most images attached to a single multi-image reader request
+MAX_IMAGES_PER_REQUEST = 10
+
+# Token budget for the Q&A history sent with each QA anchor prompt
+CHAT_TOKEN_BUDGET = 6000
+
+# Session state key of the reader report cache, mapping report_cache_key() to a usable report
+READER_CACHE_KEY = "reader_cache"
+
+# Undesired language in a reader report. "AI" is matched case-sensitively as a whole word,
+# since a case-insensitive match would hit the "Airways" section of every report.
+_BAN_WORDS_RE = re.compile(r"(?i:sorry|certainly)|\bAI\b")
+
+# Trailing periods and (Unicode) whitespace after the last sentence of an answer
+_TRAILING_PERIODS_RE = re.compile(r"[\s.]+\Z")
+
+# Q&A messages that end the session and generate the final report
+_STOP_WORDS = frozenset({"stop", "quit", "exit", "finish", "end"})
+
+# Words that mark a Q&A message as possibly changing the report, so the report update is run
+_UPDATE_KEYWORDS = (
+    "add",
+    "adds",
+    "added",
+    "adding",
+    "update",
+    "updates",
+    "updated",
+    "updating",
+    "change",
+    "changes",
+    "changed",
+    "changing",
+    "correct",
+    "corrects",
+    "corrected",
+    "correction",
+    "remove",
+    "removes",
+    "removed",
+    "removing",
+    "delete",
+    "deleted",
+    "replace",
+    "replaced",
+    "edit",
+    "edited",
+    "revise",
+    "revised",
+    "modify",
+    "modified",
+    "amend",
+    "amended",
+    "fix",
+    "fixed",
+    "rewrite",
+    "rephrase",
+    "incorporate",
+    "incorporated",
+    "finding",
+    "findings",
+    "impression",
+    "impressions",
+    "plan",
+    "plans",
+)
+# Keywords are matched as whole words, so e.g. "address" or "plane" don't count
+_UPDATE_RE = re.compile(
+    r"\b(?:" + "|".join(map(re.escape, _UPDATE_KEYWORDS)) + r")\b", re.IGNORECASE
+)
+
+# QA anchor prompt templates, dedented once at import and filled in with str.format
+_QUESTION_TMPL = dedent(
+    """\
+    Current Report:
+    {report}
+
+    User Question: {question}
+
+    Please answer the user's question directly based on the report above."""
+)
+
+_UPDATE_TMPL = dedent(
+    """\
+    Current Report:
+    {report}
+
+    Recent Q&A Session:
+    {chat_context}
+
+    Please update the report based on the information from the Q&A session above.
+    IF NOTHING SPECIAL TO UPDATE, JUST PRINT THE INPUT REPORT.
+    Incorporate any relevant new information while maintaining the report structure.
+    """
+)
+
+_FINAL_TMPL = dedent(
+    """
+    Current Report:
+    {report}
+
+    Complete Q&A Session:
+    {chat_context}
+
+    User has requested to finalize the report. Please provide the final comprehensive CXR report
+    that incorporates all the information from our Q&A session. Maintain the existing report structure
+    and ensure all relevant details are included.
+    """
+)
+
+# Outermost JSON array in a response that may be wrapped in prose or code fences
+_JSON_ARRAY_RE = re.compile(r"\[.*\]", re.DOTALL)
+
+# The four standard report sections, in order, and a pattern matching any of their headers
+_SECTIONS = ("Patient Information", "Findings", "Impression", "Plan")
+_SECTIONS_RE = re.compile(r"\*\*(Patient Information|Findings|Impression|Plan):\*\*")
+
+# Parsed sections per report string, so each distinct report is split only once
+_PARSE_CACHE: Dict[str, dict] = {}
+_PARSE_CACHE_MAX = 1024
+
+
+def is_usable_report(content: str) -> bool:
+    """Check that a reader report is detailed and free of undesired language."""
+    return len(content) >= 500 and not _BAN_WORDS_RE.search(content)
+
+
+def report_cache_key(image: Image, query: str) -> str:
+    """Hash an image's bytes together with its patient information query."""
+    if image.content is not None:
+        data = image.content
+    elif image.filepath is not None:
+        with open(image.filepath, "rb") as f:
+            data = f.read()
+    else:
+        data = str(image.url).encode()
+
+    digest = hashlib.blake2b(data, digest_size=16)
+    digest.update(query.encode())
+    return digest.hexdigest()
+
+
+def _reader_cache() -> Dict[str, RunResponse]:
+    """Return this session's reader report cache, which survives Streamlit reruns and resets."""
+    import streamlit as st
+
+    return st.session_state.setdefault(READER_CACHE_KEY, {})
+
+
+def wants_report_update(user_input: str) -> bool:
+    """Check whether a Q&A message may ask for a change to the report."""
+    return _UPDATE_RE.search(user_input) is not None
+
+
+@functools.lru_cache(maxsize=None)
+def _encoding():
+    """Load the tokenizer used by the QA anchor's model, or None if it is unavailable."""
+    if not TIKTOKEN_AVAILABLE:
+        return None
+    try:
+        try:
+            return tiktoken.encoding_for_model("gpt-4o-mini")
+        except KeyError:
+            # Older tiktoken releases don't know the model name
+            return tiktoken.get_encoding("o200k_base")
+    except Exception as e:
+        # tiktoken downloads its BPE file on first use, which fails e.g. offline
+        logger.warning(f"Could not load the tokenizer, estimating token counts: {str(e)}")
+        return None
+
+
+def count_tokens(text: str) -> int:
+    """Count the tokens in text, estimating 4 characters per token without a tokenizer."""
+    encoding = _encoding()
+    if encoding is None:
+        return len(text) // 4
+    return len(encoding.encode(text))
+
+
+def log_cached_tokens(response: RunResponse) -> None:
+    """Log how many prompt tokens of a run were served from OpenAI's prompt cache."""
+    details = (response.metrics or {}).get("prompt_tokens_details") or []
+    cached_tokens = sum(
+        (detail.get("cached_tokens") or 0) for detail in details if isinstance(detail, dict)
+    )
+    logger.info(f"Cached prompt tokens: {cached_tokens}")
 
 
 class CXR_Report_Generator(Workflow):
@@ -37,26 +238,68 @@ The final report is subsequently updated with the gathered insights, ensuring th
 """
     )
 
-    def __init__(self):
-        super().__init__()
+    # The agents are only built on first use, so e.g. a session that reuses cached
+    # reports never constructs the reader
+    @functools.cached_property
+    def reader(self) -> Agent:
+        from agent import create_reader
+
+        return create_reader()
+
+    @functools.cached_property
+    def qa_anchor(self) -> Agent:
+        from agent import create_qa_anchor, CXR_DEBUG
+
+        return create_qa_anchor(debug=CXR_DEBUG)
 
-        self.reader = create_reader()
-        self.qa_anchor = create_qa_anchor()
+    @functools.cached_property
+    def compactor(self) -> Agent:
+        from agent import create_compactor
 
-    def generate_cxr_report(self, image: Image) -> RunResponse:
-        """Generate a CXR report using the reader_anchor."""
+        return create_compactor()
+
+    def generate_cxr_report(
+        self, image: Image, query: str, placeholder: Optional[Any] = None
+    ) -> RunResponse:
+        """
+        Generate a complete CXR report, including the patient header, using the reader.
+
+        Args:
+            image: The chest X-ray image to analyze
+            query: Patient information for the report header
+            placeholder: Optional st.empty() placeholder the report is streamed into as it is generated
+        """
         try:
+            # The same image and patient information always get the cached report
+            cache = _reader_cache()
+            cache_key = report_cache_key(image, query)
+            if cache_key in cache:
+                return cache[cache_key]
+
             # Actual agent run
             ATTEMPTS = 15
-            ban_words = ("sorry", "certainly", "AI")
             for attempt in range(ATTEMPTS):
                 logger.info(f"Attempt {attempt+1}/{ATTEMPTS}")
-                reader_ans: RunResponse = self.reader.run(images=[image])
+                # stream is passed explicitly: a streamed run sets the agent's stream flag,
+                # which later calls without stream= would pick up
+                if placeholder is None:
+                    reader_ans: RunResponse = self.reader.run(
+                        query, images=[image], stream=False
+                    )
+                else:
+                    # Stream on a copy so the shared reader keeps stream off
+                    reader = self.reader.deep_copy()
+                    chunks = []
+                    for chunk in reader.run(query, images=[image], stream=True):
+                        chunks.append(chunk.content or "")
+                        placeholder.markdown("".join(chunks))
+                    # The agent accumulates the streamed chunks into its run response
+                    reader_ans = reader.run_response
+                log_cached_tokens(reader_ans)
                 # Ensure the report is detailed and free of undesired language.
-                if len(reader_ans.content) < 500 or any(
-                    word in reader_ans.content.strip().lower() for word in ban_words
-                ):
+                if not is_usable_report(reader_ans.content):
                     continue
+                cache[cache_key] = reader_ans
                 break
 
             return reader_ans
@@ -65,6 +308,275 @@ The final report is subsequently updated with the gathered insights, ensuring th
             # Return an error message as the response
             return RunResponse(content=f"Error generating report: {str(e)}")
 
+    def generate_cxr_reports_batched(
+        self, images: List[Image], queries: List[str]
+    ) -> List[Optional[RunResponse]]:
+        """
+        Generate reports for several images with a single reader request.
+
+        Args:
+            images: The chest X-ray images to analyze
+            queries: Patient information for each image, in the same order as images
+
+        Returns:
+            List[Optional[RunResponse]]: The report for each image, or None where the
+            response could not be parsed or failed the report checks
+        """
+        from agent import BATCH_OUTPUT_INSTRUCTIONS
+
+        reports: List[Optional[RunResponse]] = [None] * len(images)
+
+        # Only the images without a cached report are sent, indexed by their position in missing
+        cache = _reader_cache()
+        cache_keys = [
+            report_cache_key(image, image_query) for image, image_query in zip(images, queries)
+        ]
+        missing = []
+        for position, cache_key in enumerate(cache_keys):
+            if cache_key in cache:
+                reports[position] = cache[cache_key]
+            else:
+                missing.append(position)
+        if not missing:
+            return reports
+
+        query = "\n".join(
+            f"[{index}]\n{queries[position].strip()}\n"
+            for index, position in enumerate(missing)
+        )
+
+        try:
+            reader_ans: RunResponse = self.reader.run(
+                f"{query}\n{BATCH_OUTPUT_INSTRUCTIONS}",
+                images=[images[position] for position in missing],
+                stream=False,
+            )
+            log_cached_tokens(reader_ans)
+            match = _JSON_ARRAY_RE.search(reader_ans.content or "")
+            items = json.loads(match.group(0)) if match else []
+        except Exception as e:
+            logger.warning(f"Multi-image report generation failed: {str(e)}")
+            return reports
+
+        for item in items:
+            if not isinstance(item, dict):
+                continue
+            index = item.get("index")
+            if not isinstance(index, int) or not 0 <= index < len(missing):
+                continue
+            position = missing[index]
+
+            content = (
+                f"**Patient Information:**\n{item.get('patient_information', '')}\n\n"
+                f"**Findings:**\n{item.get('findings', '')}\n\n"
+                f"**Impression:**\n{item.get('impression', '')}\n\n"
+                f"**Plan:**\n{item.get('plan', '')}"
+            )
+            if is_usable_report(content):
+                reports[position] = RunResponse(content=content)
+                cache[cache_keys[position]] = reports[position]
+
+        return reports
+
+    async def agenerate_cxr_report(
+        self,
+        image: Image,
+        query: str,
+        reader: Agent,
+        placeholder: Optional[Any] = None,
+    ) -> RunResponse:
+        """Async variant of generate_cxr_report, run against the given reader agent."""
+        try:
+            ATTEMPTS = 15
+            for attempt in range(ATTEMPTS):
+                logger.info(f"Attempt {attempt+1}/{ATTEMPTS}")
+                if placeholder is None:
+                    reader_ans: RunResponse = await reader.arun(
+                        query, images=[image], stream=False
+                    )
+                else:
+                    chunks = []
+                    async for chunk in await reader.arun(
+                        query, images=[image], stream=True
+                    ):
+                        chunks.append(chunk.content or "")
+                        placeholder.markdown("".join(chunks))
+                    reader_ans = reader.run_response
+                log_cached_tokens(reader_ans)
+                if not is_usable_report(reader_ans.content):
+                    continue
+                break
+
+            return reader_ans
+
+        except Exception as e:
+            return RunResponse(content=f"Error generating report: {str(e)}")
+
+    async def agenerate_cxr_reports(
+        self,
+        images: Dict[str, Tuple[Image, str]],
+        max_concurrency: int = MAX_CONCURRENT_READS,
+        placeholders: Optional[Dict[str, Any]] = None,
+    ) -> Dict[str, RunResponse]:
+        """
+        Generate the reader reports for several images concurrently.
+
+        Args:
+            images: Mapping of image_id to the chest X-ray image and its patient information query
+            max_concurrency: Maximum number of reader requests in flight at once
+            placeholders: Optional mapping of image_id to an st.empty() placeholder each report is streamed into
+
+        Returns:
+            Dict[str, RunResponse]: The reader report for each image_id
+        """
+        # Cached reports are returned as is; only the remaining images are read
+        cache = _reader_cache()
+        cache_keys = {
+            image_id: report_cache_key(image, query)
+            for image_id, (image, query) in images.items()
+        }
+        cached = {
+            image_id: cache[cache_key]
+            for image_id, cache_key in cache_keys.items()
+            if cache_key in cache
+        }
+        if len(cached) == len(images):
+            return cached
+
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        # One connection pool shared by every request in this batch
+        async with httpx.AsyncClient() as http_client:
+            async_client = AsyncOpenAI(http_client=http_client)
+
+            async def _run_one(image_id: str, image: Image, query: str):
+                async with semaphore:
+                    # Agent runs keep per-run state, so each task gets its own copy
+                    reader = self.reader.deep_copy()
+                    reader.model.async_client = async_client
+                    placeholder = (placeholders or {}).get(image_id)
+                    return image_id, await self.agenerate_cxr_report(
+                        image, query, reader, placeholder
+                    )
+
+            results = await asyncio.gather(
+                *(
+                    _run_one(image_id, image, query)
+                    for image_id, (image, query) in images.items()
+                    if image_id not in cached
+                )
+            )
+
+        for image_id, reader_ans in results:
+            if is_usable_report(reader_ans.content):
+                cache[cache_keys[image_id]] = reader_ans
+        return {**cached, **dict(results)}
+
+    def append_chat(self, image_id: str, sender: str, message: str) -> None:
+        """
+        Add a message to a Q&A session's chat history and its running chat context.
+
+        Args:
+            image_id: The identifier of the Q&A session
+            sender: "user" or "assistant"
+            message: The message text
+        """
+        import streamlit as st
+
+        st.session_state.setdefault(f"chat_history_{image_id}", []).append(
+            (sender, message)
+        )
+        self._extend_chat_context(image_id, sender, message)
+
+    def _extend_chat_context(self, image_id: str, sender: str, message: str) -> None:
+        """Append one "sender: message" line to the session's (chat context, token count)."""
+        import streamlit as st
+
+        context_key = f"chat_context_{image_id}"
+        chat_context, tokens = st.session_state.get(context_key, ("", 0))
+        line = f"{sender}: {message}"
+        st.session_state[context_key] = (
+            f"{chat_context}\n{line}" if chat_context else line,
+            tokens + count_tokens(line),
+        )
+
+    def build_chat_context(self, image_id: str) -> str:
+        """
+        Build the Q&A history sent with QA anchor prompts, within CHAT_TOKEN_BUDGET.
+
+        Once the history exceeds the budget, the most recent messages that fit in half of it
+        are kept verbatim and everything older is replaced with a summary.
+
+        Args:
+            image_id: The identifier of the Q&A session
+
+        Returns:
+            str: One "sender: message" line per message, led by the summary when compacted
+        """
+        import streamlit as st
+
+        history = st.session_state[f"chat_history_{image_id}"]
+        context_key = f"chat_context_{image_id}"
+        if context_key not in st.session_state:
+            # Rebuild the running context for a history that was set without append_chat
+            st.session_state[context_key] = ("", 0)
+            for sender, message in history:
+                self._extend_chat_context(image_id, sender, message)
+
+        # The running context is kept up to date by append_chat, so it is not rejoined per turn
+        chat_context, tokens = st.session_state[context_key]
+        if tokens <= CHAT_TOKEN_BUDGET:
+            return chat_context
+
+        lines = [f"{sender}: {message}" for sender, message in history]
+
+        # Keep as many of the latest messages as fit in half of the budget (at least one)
+        kept = 0
+        used = 0
+        for line in reversed(lines):
+            used += count_tokens(line)
+            if kept and used > CHAT_TOKEN_BUDGET // 2:
+                break
+            kept += 1
+
+        older = lines[:-kept]
+        if not older:
+            return chat_context
+
+        summary = self.summarize_chat(image_id, older)
+        return f"Summary so far: {summary}\n" + "\n".join(lines[-kept:])
+
+    def summarize_chat(self, image_id: str, lines: List[str]) -> str:
+        """
+        Summarize older Q&A messages, reusing the session's previous summary when possible.
+
+        Args:
+            image_id: The identifier of the Q&A session
+            lines: The "sender: message" lines to summarize, oldest first
+
+        Returns:
+            str: The summary of the given messages
+        """
+        import streamlit as st
+
+        summary_key = f"chat_summary_{image_id}"
+        summarized, summary = st.session_state.get(summary_key, (0, ""))
+
+        if summarized == len(lines):
+            return summary
+
+        if 0 < summarized < len(lines):
+            # Only the messages that fell out of the window since the last summary are new
+            prompt = f"Previous summary:\n{summary}\n\nNew messages:\n" + "\n".join(
+                lines[summarized:]
+            )
+        else:
+            prompt = "Messages:\n" + "\n".join(lines)
+
+        summary = self.compactor.run(prompt).content
+        st.session_state[summary_key] = (len(lines), summary)
+        return summary
+
     def run_qa_session(self, image_id: str = "default") -> RunResponse:
         """
         Run an interactive Q&A session with the user about the chest X-ray report.
@@ -76,6 +588,8 @@ The final report is subsequently updated with the gathered insights, ensuring th
         Returns:
             RunResponse: The final response after completing the Q&A session
         """
+        import streamlit as st
+
         # Setup key names for session state
         chat_history_key = f"chat_history_{image_id}"
         qa_complete_key = f"qa_complete_{image_id}"
@@ -83,11 +597,11 @@ The final report is subsequently updated with the gathered insights, ensuring th
         current_report_key = (
             f"current_report_{image_id}"  # Key to track the evolving report
         )
-        pending_msg_key = f"pending_msg_{image_id}"  # Key for pending assistant message
 
         # Initialize chat history if not already present
         if chat_history_key not in st.session_state:
             st.session_state[chat_history_key] = []
+            st.session_state.pop(f"chat_context_{image_id}", None)
 
         # If Q&A session is already complete, just return the final report
         if (
@@ -96,10 +610,12 @@ The final report is subsequently updated with the gathered insights, ensuring th
         ):
             return st.session_state[final_report_key]
 
-        # Show the current evolving report at the top
+        # Show the current evolving report at the top, in a placeholder that is updated in place
+        report_placeholder = None
         if current_report_key in st.session_state:
             with st.expander("Report Detail", expanded=True):
-                st.markdown(st.session_state[current_report_key])
+                report_placeholder = st.empty()
+            report_placeholder.markdown(st.session_state[current_report_key])
 
         # Display the chat history
         for i, (sender, message) in enumerate(st.session_state[chat_history_key]):
@@ -110,12 +626,8 @@ The final report is subsequently updated with the gathered insights, ensuring th
             with st.chat_message(sender):
                 st.markdown(message)
 
-        # Check if there's a pending message to display
-        if pending_msg_key in st.session_state:
-            with st.chat_message("assistant"):
-                st.markdown(st.session_state[pending_msg_key])
-            # Clear the pending message
-            del st.session_state[pending_msg_key]
+        # New messages of this turn are drawn here, below the history, without a rerun
+        new_messages = st.container()
 
         # Get user input for the Q&A session
         st.info(
@@ -126,10 +638,12 @@ The final report is subsequently updated with the gathered insights, ensuring th
         # Process user input
         if user_input:
             # Add user input to chat history
-            st.session_state[chat_history_key].append(("user", user_input))
+            self.append_chat(image_id, "user", user_input)
+            with new_messages, st.chat_message("user"):
+                st.markdown(user_input)
 
             # Check if user wants to stop
-            if user_input.lower().strip() in ["stop", "quit", "exit", "finish", "end"]:
+            if user_input.strip().lower() in _STOP_WORDS:
                 # Generate final summary based on Q&A session
                 with st.spinner("Generating final report based on Q&A session..."):
 
@@ -138,27 +652,12 @@ The final report is subsequently updated with the gathered insights, ensuring th
                         latest_report = st.session_state.get(current_report_key, "")
 
                         # Get all chat messages for complete context
-                        chat_context = "\n".join(
-                            [
-                                f"{sender}: {message}"
-                                for sender, message in st.session_state[
-                                    chat_history_key
-                                ]
-                            ]
-                        )
+                        chat_context = self.build_chat_context(image_id)
 
                         # Create a final prompt that includes the latest report and all Q&A interactions
-                        final_prompt = f"""
-                        Current Report:
-                        {latest_report}
-                        
-                        Complete Q&A Session:
-                        {chat_context}
-                        
-                        User has requested to finalize the report. Please provide the final comprehensive CXR report
-                        that incorporates all the information from our Q&A session. Maintain the existing report structure
-                        and ensure all relevant details are included.
-                        """
+                        final_prompt = _FINAL_TMPL.format(
+                            report=latest_report, chat_context=chat_context
+                        )
 
                         # Generate the final report
                         final_response = self.qa_anchor.run(final_prompt)
@@ -180,11 +679,10 @@ The final report is subsequently updated with the gathered insights, ensuring th
                         st.session_state[qa_complete_key] = True
 
                         # Add the final response to chat history
-                        st.session_state[chat_history_key].append(
-                            (
-                                "assistant",
-                                "Q&A session complete. Final report generated.",
-                            )
+                        self.append_chat(
+                            image_id,
+                            "assistant",
+                            "Q&A session complete. Final report generated.",
                         )
 
                         # Show success message
@@ -198,11 +696,10 @@ The final report is subsequently updated with the gathered insights, ensuring th
                         st.error(error_msg)
 
                         # Add error to chat history
-                        st.session_state[chat_history_key].append(
-                            (
-                                "assistant",
-                                f"⚠️ {error_msg} Please try again or contact support.",
-                            )
+                        self.append_chat(
+                            image_id,
+                            "assistant",
+                            f"⚠️ {error_msg} Please try again or contact support.",
                         )
 
                         # Ensure we have a reasonable fallback report
@@ -222,14 +719,8 @@ The final report is subsequently updated with the gathered insights, ensuring th
                         latest_report = st.session_state.get(current_report_key, "")
 
                         # 1. Get direct response to the user's question, with the latest report as context
-                        question_with_context = dedent(
-                            f"""\
-                        Current Report:
-                        {latest_report}
-                        
-                        User Question: {user_input}
-                        
-                        Please answer the user's question directly based on the report above."""
+                        question_with_context = _QUESTION_TMPL.format(
+                            report=latest_report, question=user_input
                         )
 
                         response = self.qa_anchor.run(question_with_context)
@@ -254,82 +745,60 @@ The final report is subsequently updated with the gathered insights, ensuring th
 
                         # If it's a report format, get only the last sentence
                         if is_report_format:
-                            # Split by periods and get the last non-empty sentence
-                            sentences = [
-                                s.strip()
-                                for s in response_content.split(".")
-                                if s.strip()
-                            ]
-                            if sentences:
-                                chat_display_content = sentences[
-                                    -1
-                                ]  # Do you have further questions?
+                            # Scan back from the end for the last non-empty sentence,
+                            # ignoring trailing periods and whitespace
+                            body = _TRAILING_PERIODS_RE.sub("", response_content)
+                            if body:
+                                chat_display_content = body[
+                                    body.rfind(".") + 1 :
+                                ].strip()  # Do you have further questions?
                             else:
                                 chat_display_content = "I've updated the report."
                         else:
                             # Use the full content if not a report
                             chat_display_content = response_content
 
-                        # Store the full response as a pending message to display in chat
-                        st.session_state[pending_msg_key] = chat_display_content
-
                         # Add to chat history - only the last sentence if it's a report
-                        st.session_state[chat_history_key].append(
-                            ("assistant", chat_display_content)
-                        )
-
-                        # 2. Generate an updated comprehensive report that incorporates this QA interaction
-                        with st.spinner("Updating the report with this information..."):
-                            # Get all chat messages since the last report update
-                            chat_context = "\n".join(
-                                [
-                                    f"{sender}: {message}"
-                                    for sender, message in st.session_state[
-                                        chat_history_key
-                                    ]
-                                ]
-                            )
-
-                            # Provide the QA anchor with the latest report and the recent chat messages
-                            update_prompt = dedent(
-                                f"""\
-                            Current Report:
-                            {latest_report}
-                            
-                            Recent Q&A Session:
-                            {chat_context}
-                            
-                            Please update the report based on the information from the Q&A session above.
-                            IF NOTHING SPECIAL TO UPDATE, JUST PRINT THE INPUT REPORT.
-                            Incorporate any relevant new information while maintaining the report structure.
-                            """
-                            )
-
-                            updated_report_response = self.qa_anchor.run(update_prompt)
-
-                            # Store the updated report
-                            st.session_state[
-                                current_report_key
-                            ] = updated_report_response.content
-
-                        # Force UI refresh to update both chat and report
-                        st.rerun()
+                        self.append_chat(image_id, "assistant", chat_display_content)
+                        with new_messages, st.chat_message("assistant"):
+                            st.markdown(chat_display_content)
+
+                        # 2. Generate an updated comprehensive report that incorporates this QA interaction,
+                        # unless the question can't change the report (the anchor would echo it back).
+                        # A later update or the final report still sees this turn in the chat context.
+                        if wants_report_update(user_input):
+                            with st.spinner("Updating the report with this information..."):
+                                # Get all chat messages since the last report update
+                                chat_context = self.build_chat_context(image_id)
+
+                                # Provide the QA anchor with the latest report and the recent chat messages
+                                update_prompt = _UPDATE_TMPL.format(
+                                    report=latest_report, chat_context=chat_context
+                                )
+
+                                updated_report_response = self.qa_anchor.run(update_prompt)
+
+                                # Store the updated report
+                                st.session_state[
+                                    current_report_key
+                                ] = updated_report_response.content
+
+                            # Update the report in place; the new messages are already shown
+                            if report_placeholder is not None:
+                                report_placeholder.markdown(
+                                    st.session_state[current_report_key]
+                                )
                     except Exception as e:
                         error_msg = f"Error generating response: {str(e)}"
                         st.error(error_msg)
 
                         # Add error to chat history, but format it as assistant message
                         error_response = f"⚠️ I encountered an error while processing your question: {str(e)}. Please try again or rephrase your question."
-                        st.session_state[chat_history_key].append(
-                            ("assistant", error_response)
-                        )
-
-                        # If we have a pending message key, clear it to avoid confusion
-                        if pending_msg_key in st.session_state:
-                            del st.session_state[pending_msg_key]
+                        self.append_chat(image_id, "assistant", error_response)
+                        with new_messages, st.chat_message("assistant"):
+                            st.markdown(error_response)
 
                         # Don't update the report if we had an error in the response
-                        st.rerun()
 
         # Return appropriate response based on state
         if final_report_key in st.session_state:
@@ -348,7 +817,7 @@ The final report is subsequently updated with the gathered insights, ensuring th
     def run(self, query: str, image: Image, image_id: str = None) -> RunResponse:
         """
         Modularized run method that:
-        1. Generates a CXR report.
+        1. Generates a CXR report, formatted with its patient information header.
         2. Starts an interactive Q&A session with the generated report.
 
         Args:
@@ -356,6 +825,7 @@ The final report is subsequently updated with the gathered insights, ensuring th
             image: The chest X-ray image to analyze
             image_id: A unique identifier for the image/report (defaults to image filename)
         """
+        import streamlit as st
 
         # Reset the chat history for this image_id - important to clear between runs
         chat_history_key = f"chat_history_{image_id}"
@@ -365,19 +835,17 @@ The final report is subsequently updated with the gathered insights, ensuring th
         report_key = f"report_{image_id}"
         qa_anchor_key = f"qa_anchor_{image_id}"
 
-        # Initialize session state variables if this is a new image or we're reprocessing
-        should_initialize = (
-            st.session_state.get("current_image_index", 0)
-            == len(st.session_state.get("all_reports", []))
-            or qa_complete_key not in st.session_state
-            or not st.session_state.get(qa_complete_key, False)
-        )
+        # Initialize session state variables only for a new image or when reprocessing
+        # (clear_image_state removes the anchor key), so the Q&A history survives reruns
+        should_initialize = qa_anchor_key not in st.session_state
 
         if should_initialize:
             # Clear existing chat history to start fresh
             if chat_history_key in st.session_state:
                 del st.session_state[chat_history_key]
             st.session_state[chat_history_key] = []
+            st.session_state.pop(f"chat_context_{image_id}", None)
+            st.session_state.pop(f"chat_summary_{image_id}", None)
 
             # Reset Q&A completion flag
             st.session_state[qa_complete_key] = False
@@ -385,53 +853,37 @@ The final report is subsequently updated with the gathered insights, ensuring th
         # Step 1: Generate the CXR report or retrieve from session state if already generated
         if report_key not in st.session_state:
             with st.spinner(f"Generating CXR report for Image {image_id}..."):
-                reader_ans = self.generate_cxr_report(image)
+                # Stream the report as it is generated; it is shown in the Q&A section once done
+                placeholder = st.empty()
+                reader_ans = self.generate_cxr_report(image, query, placeholder)
+                placeholder.empty()
                 # Store report in session state to avoid regenerating it
                 st.session_state[report_key] = reader_ans
-
-                # Create a QA anchor - this is a separate agent for each image
-                initial_context = f"""
-                Please generate a properly formatted CXR report based on the following information:
-
-                Patient Information:
-                {query}
-
-                CXR Analysis:
-                {reader_ans.content}
-
-                Format the report with clear sections in this exact order:
-                1. Patient Information (including ID, follow-up, age, gender, view position, and possible diseases)
-                2. Findings (including airways, bones and soft tissues, cardiac silhouette and mediastinum, diaphragm and pleural spaces, and lungs)
-                3. Impression (key findings and clinical implications)
-                4. Plan (recommended next steps)
-                """
-
-                # Store it in the session state
-                initial_response = self.qa_anchor.run(initial_context)
-
-                # Ensure we have valid content
-                if hasattr(initial_response, "content") and initial_response.content:
-                    initial_content = initial_response.content
-                else:
-                    initial_content = str(initial_response)
-
-                st.session_state[qa_anchor_key] = initial_response
-                st.session_state[f"current_report_{image_id}"] = initial_content
-
-                # Add initial message to chat history
-                if (
-                    chat_history_key not in st.session_state
-                    or not st.session_state[chat_history_key]
-                ):
-                    initial_response = st.session_state[qa_anchor_key]
-                    st.session_state[chat_history_key] = [
-                        ("assistant", initial_response.content)
-                    ]
         else:
             # Retrieve existing report from session state
             reader_ans = st.session_state[report_key]
             st.success(f"Retrieved existing report for Image {image_id}")
 
+        # The reader report already carries the patient header and final formatting,
+        # so it seeds the Q&A session directly without a separate formatting call
+        if qa_anchor_key not in st.session_state:
+            # The anchor is reused across images, so drop the previous image's conversation
+            # (its memory is only created by its first run)
+            if self.qa_anchor.memory is not None:
+                self.qa_anchor.memory.clear()
+
+            st.session_state[qa_anchor_key] = reader_ans
+            st.session_state[f"current_report_{image_id}"] = reader_ans.content
+
+            # Add initial message to chat history
+            if (
+                chat_history_key not in st.session_state
+                or not st.session_state[chat_history_key]
+            ):
+                st.session_state[chat_history_key] = []
+                st.session_state.pop(f"chat_context_{image_id}", None)
+                self.append_chat(image_id, "assistant", reader_ans.content)
+
         # Combine the original query with the generated report as context for the Q&A session.
         initial_context = query + reader_ans.content
 
@@ -450,38 +902,31 @@ def parse_report(report_content: str) -> dict:
     Returns:
         dict: A dictionary with section names as keys and their corresponding content as values
     """
-    # The four standard sections
-    sections = ["Patient Information", "Findings", "Impression", "Plan"]
-    parsed_report = {}
-
-    # Extract each section using the standard markdown format
-    for i, section in enumerate(sections):
-        # Find the section header
-        pattern = f"\\*\\*{section}:\\*\\*"
-        match = re.search(pattern, report_content)
-
-        if match:
-            # Get the start position (after the header)
-            start_idx = match.end()
-
-            # Find the end - either the next section or the end of the content
-            if i < len(sections) - 1:
-                end_pattern = f"\\*\\*{sections[i+1]}:\\*\\*"
-                end_match = re.search(end_pattern, report_content[start_idx:])
-
-                if end_match:
-                    end_idx = start_idx + end_match.start()
-                else:
-                    end_idx = len(report_content)
-            else:
-                # Last section goes to the end
-                end_idx = len(report_content)
-
-            # Extract and clean the content
-            content = report_content[start_idx:end_idx].strip()
-            parsed_report[section] = content
-        else:
-            # If section not found, provide an empty string
-            parsed_report[section] = ""
+    parsed_report = _PARSE_CACHE.get(report_content)
+    if parsed_report is None:
+        parsed_report = _parse_sections(report_content)
+        if len(_PARSE_CACHE) >= _PARSE_CACHE_MAX:
+            # Evict the oldest entry
+            _PARSE_CACHE.pop(next(iter(_PARSE_CACHE)), None)
+        _PARSE_CACHE[report_content] = parsed_report
+
+    # Callers edit the sections in place, so each gets its own copy
+    return dict(parsed_report)
+
+
+def _parse_sections(report_content: str) -> dict:
+    """Split the report into the standard four sections, without caching."""
+    # If a section is not found, it is left as an empty string
+    parsed_report = dict.fromkeys(_SECTIONS, "")
+    found = set()
+
+    # Each section runs from its header to the next section header or the end of the content
+    matches = list(_SECTIONS_RE.finditer(report_content))
+    for match, next_match in zip(matches, matches[1:] + [None]):
+        section = match.group(1)
+        if section not in found:
+            found.add(section)
+            end = next_match.start() if next_match else None
+            parsed_report[section] = report_content[match.end() : end].strip()
 
     return parsed_report